@@ -0,0 +1,151 @@
+import functools
+from collections.abc import Iterator
+
+from virsh import quote_arg
+
+# -------------------------------
+# Key Map (Pre-computed constant for maximum performance)
+# -------------------------------
+
+def _build_key_map() -> dict[str, tuple[list[str], str]]:
+    """Build and pre-compute key map as lists for optimal performance."""
+    base_symbols = {
+        '-': '0x2d', '=': '0x2e', '[': '0x2f', ']': '0x30', '\\': '0x64',
+        ';': '0x33', "'": '0x34', ',': '0x36', '.': '0x37', '/': '0x38', '`': '0x35'
+    }
+    shift_pairs = {
+        '-': '_', '=': '+', '[': '{', ']': '}', '\\': '|',
+        ';': ':', "'": '"', ',': '<', '.': '>', '/': '?', '`': '~'
+    }
+
+    # Unshifted keys
+    plain = {
+        # a–z
+        **{chr(c): f"0x{c - 93:02x}" for c in range(97, 123)},
+        # Numbers 1–0
+        **{str(i): f"0x{0x1d + i:02x}" for i in range(1, 10)},
+        "0": "0x27",
+        # Symbols
+        **base_symbols,
+        # Space and controls
+        " ": "0x2c", "\n": "0x28", "\t": "0x2b",
+    }
+    # Shifted characters and the unshifted key each one is typed with
+    shifted = {
+        # A–Z
+        **{chr(c).upper(): chr(c) for c in range(97, 123)},
+        # Shifted numbers !@#$%^&*()
+        **dict(zip("!@#$%^&*()", "1234567890")),
+        # Shifted symbols
+        **{shift_pairs[k]: k for k in base_symbols},
+    }
+
+    # Emit the sequence lists and their debug form directly, so no code
+    # string is formatted, split and re-joined at import
+    key_map = {char: ([code], code) for char, code in plain.items()}
+    for char, base in shifted.items():
+        code = plain[base]
+        key_map[char] = (["0xe1", code], f"0xe1 + {code}")
+    return key_map
+
+def _build_key_table(key_map: dict[str, tuple[list[str], str]]) -> list[tuple[list[str], str] | None]:
+    """Index key map entries by ord(char) so the hot loop avoids hashing."""
+    table: list[tuple[list[str], str] | None] = [None] * 128
+    for char, entry in key_map.items():
+        table[ord(char)] = entry
+    return table
+
+# Pre-computed module-level constant - built once, used many times
+KEY_MAP = _build_key_map()
+
+# Every supported key is ASCII, so the hot loop indexes this by ord(char)
+KEY_TABLE = _build_key_table(KEY_MAP)
+
+# ASCII codes without a key, deleted up front by strip_unsupported
+_UNSUPPORTED = bytes(code for code, entry in enumerate(KEY_TABLE) if entry is None)
+
+def strip_unsupported(text: str) -> str:
+    """Drop every character that has no key, in C instead of per character.
+
+    Lets the non-debug send loops assume every group has a command.
+    """
+    return text.encode("ascii", "ignore").translate(None, _UNSUPPORTED).decode("ascii")
+
+# virsh presses all codes of one send-key call as a chord, so only distinct
+# unshifted keys can share an invocation
+MAX_BATCH = 4
+
+# Code of every key that may join a batch (unshifted, not space), else None,
+# so group_keys classifies a character with a single index
+BATCH_TABLE: list[str | None] = [
+    entry[0][0] if entry and len(entry[0]) == 1 and code != ord(" ") else None
+    for code, entry in enumerate(KEY_TABLE)
+]
+
+def group_keys(text: str, commands: tuple[str, str, tuple[str | None, ...]], debug: bool = False) -> Iterator[tuple[str, str | None, str | None]]:
+    """Split text into (chars, command, formatted_seq) groups, each one write to virsh.
+
+    Runs of unshifted keys are batched into one send-key line of up to
+    MAX_BATCH codes. Every other key gets its own line, and a run of the
+    same such key (e.g. several spaces) is rendered as one repeated block.
+    Unsupported characters are yielded with a None command.
+
+    `commands` is the (prefix, suffix, table) tuple from build_commands.
+    A batch's formatted_seq is only joined when `debug` asks for it.
+    """
+    prefix, suffix, cmd_table = commands
+    chars = ""
+    codes: list[str] = []
+    run_char = ""
+    run_len = 0
+    for char in text:
+        if char == run_char:
+            run_len += 1
+            continue
+        if run_len:
+            yield _render_run(run_char, run_len, cmd_table)
+            run_char, run_len = "", 0
+
+        code = ord(char)
+        if code < 128:
+            batch_code = BATCH_TABLE[code]
+            if batch_code is not None:
+                if codes and (len(codes) == MAX_BATCH or batch_code in codes):
+                    yield chars, f"{prefix}{' '.join(codes)}{suffix}", (" + ".join(codes) if debug else None)
+                    chars, codes = char, [batch_code]
+                else:
+                    chars += char
+                    codes.append(batch_code)
+                continue
+
+        if codes:
+            yield chars, f"{prefix}{' '.join(codes)}{suffix}", (" + ".join(codes) if debug else None)
+            chars, codes = "", []
+        run_char, run_len = char, 1
+
+    if run_len:
+        yield _render_run(run_char, run_len, cmd_table)
+    if codes:
+        yield chars, f"{prefix}{' '.join(codes)}{suffix}", (" + ".join(codes) if debug else None)
+
+def _render_run(char: str, count: int, cmd_table: tuple[str | None, ...]) -> tuple[str, str | None, str | None]:
+    """Render `count` presses of a key that can't be batched as a single group."""
+    code = ord(char)
+    entry = KEY_TABLE[code] if code < 128 else None
+    if entry is None:
+        return char * count, None, None
+    return char * count, cmd_table[code] * count, entry[1]
+
+@functools.lru_cache(maxsize=8)
+def build_commands(domain: str, holdtime_str: str) -> tuple[str, str, tuple[str | None, ...]]:
+    """Pre-render the send-key command line for every ASCII character.
+
+    Returns the shared prefix and suffix as well, for batches of several keys.
+    Cached, since the GUI asks again for every Send with the same settings;
+    the table is a tuple so no caller can alter the shared copy.
+    The lines go through virsh's shell parser, hence the quoted domain name.
+    """
+    prefix = f"send-key {quote_arg(domain)} --codeset usb "
+    suffix = f" --holdtime {holdtime_str}\n"
+    table = tuple(f"{prefix}{' '.join(entry[0])}{suffix}" if entry else None for entry in KEY_TABLE)
+    return prefix, suffix, table
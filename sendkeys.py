@@ -4,23 +4,13 @@ import sys
 import os
 import time
 
+from keymap import build_commands, group_keys, strip_unsupported
+from virsh import SYNC_INTERVAL, abort_virsh, authenticate_sudo, get_domains, keep_sudo_alive, open_virsh, wait_virsh
+
 # -------------------------------
 # Utility Functions
 # -------------------------------
 
-def run_cmd(cmd: list[str]) -> str:
-    """Run a system command and return its output, or an empty string if it fails."""
-    try:
-        return subprocess.check_output(cmd, text=True, stderr=subprocess.DEVNULL).strip()
-    except subprocess.CalledProcessError:
-        return ""
-
-def get_domains() -> list[str]:
-    """Retrieve available domains from virsh."""
-    output = run_cmd(["sudo", "virsh", "list", "--all"])
-    lines = output.splitlines()[2:]  # Skip header lines
-    return [line.split()[1] for line in lines if len(line.split()) > 1]
-
 def clear_screen():
     """Clear the terminal screen (Linux-only)."""
     print("\033[H\033[J", end="")
@@ -36,64 +26,56 @@ def validate_choice(choice: str, max_choice: int) -> int:
         sys.exit("\n  <> Invalid selection.")
     return int(choice) - 1
 
-def send_keys(domain: str, char: str, holdtime_str: str, key_sequence: list[str], debug_info: str | None = None):
-    """Send keypress to a virsh domain using send-key.
-    
-    Optimized version with pre-computed values to minimize runtime overhead.
-    """
-    if debug_info:
-        print(debug_info)
-    
-    # Build command with pre-computed values (no string operations in loop)
-    cmd = ["sudo", "virsh", "send-key", domain, "--codeset", "usb", *key_sequence, "--holdtime", holdtime_str]
-    subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
-
 # -------------------------------
-# Key Map (Pre-computed constant for maximum performance)
+# Main Execution
 # -------------------------------
 
-def _build_key_map() -> dict[str, list[str]]:
-    """Build and pre-compute key map as lists for optimal performance."""
-    base_symbols = {
-        '-': '0x2d', '=': '0x2e', '[': '0x2f', ']': '0x30', '\\': '0x64',
-        ';': '0x33', "'": '0x34', ',': '0x36', '.': '0x37', '/': '0x38', '`': '0x35'
-    }
-    shift_pairs = {
-        '-': '_', '=': '+', '[': '{', ']': '}', '\\': '|',
-        ';': ':', "'": '"', ',': '<', '.': '>', '/': '?', '`': '~'
-    }
-
-    key_map_str = {
-        # a–z
-        **{chr(c): f"0x{c - 93:02x}" for c in range(97, 123)},
-        # A–Z
-        **{chr(c): f"0xe1 0x{c - 61:02x}" for c in range(65, 91)},
-        # Numbers 1–0
-        **{str(i): f"0x{0x1d + i:02x}" for i in range(1, 10)},
-        "0": "0x27",
-        # Shifted numbers !@#$%^&*()
-        **{s: f"0xe1 0x{0x1d + i:02x}" for s, i in zip("!@#$%^&*()", range(1, 11))},
-        # Symbols
-        **base_symbols,
-        # Shifted symbols
-        **{shift_pairs[k]: f"0xe1 {v}" for k, v in base_symbols.items() if k in shift_pairs},
-        # Space and controls
-        " ": "0x2c", "\n": "0x28", "\t": "0x2b",
-    }
-    
-    # Pre-split all sequences into lists for zero runtime overhead
-    return {char: seq.split() for char, seq in key_map_str.items()}
+def pause_for_spaces(virsh: subprocess.Popen, spaces: int, pause_time_sec: float):
+    """Pause once for a run of spaces, counted from when the guest received them."""
+    wait_virsh(virsh)
+    time.sleep(pause_time_sec * spaces)
 
-# Pre-computed module-level constant - built once, used many times
-KEY_MAP = _build_key_map()
+def send_text(virsh: subprocess.Popen, text: str, commands: tuple[str, str, tuple[str | None, ...]], pause_time_sec: float) -> bool:
+    """Type text into the guest, returning once it has all been received.
 
-# -------------------------------
-# Main Execution
-# -------------------------------
+    Returns False if the virsh shell exited before confirming that.
+
+    This is the common path, so it carries no debug checks at all;
+    send_text_debug mirrors it with logging.
+    """
+    for n, (chars, command, _) in enumerate(group_keys(strip_unsupported(text), commands), 1):
+        virsh.stdin.write(command)
+        # A run of spaces arrives as one group and gets one combined pause
+        if chars[0] == " ":
+            pause_for_spaces(virsh, len(chars), pause_time_sec)
+        elif n % SYNC_INTERVAL == 0:
+            wait_virsh(virsh)
+
+    return wait_virsh(virsh)
+
+def send_text_debug(virsh: subprocess.Popen, text: str, commands: tuple[str, str, tuple[str | None, ...]], pause_time_sec: float) -> bool:
+    """Same as send_text, printing every step."""
+    for n, (chars, command, formatted_seq) in enumerate(group_keys(text, commands, debug=True), 1):
+        if command is None:
+            print(f"  [DEBUG] Unsupported char skipped: {repr(chars)}")
+            continue
+
+        print(f"  [DEBUG] Sending key: {repr(chars)} → {formatted_seq}")
+        virsh.stdin.write(command)
+        if chars[0] == " ":
+            print(f"  [DEBUG] {len(chars)} space(s) detected → pausing...")
+            pause_for_spaces(virsh, len(chars), pause_time_sec)
+        elif n % SYNC_INTERVAL == 0:
+            wait_virsh(virsh)
+
+    return wait_virsh(virsh)
 
 def main():
     # Initial setup - single screen clear
     clear_screen()
+    if not authenticate_sudo():
+        sys.exit("\n  <> sudo authentication failed.")
+    keep_sudo_alive()
     domains = get_domains()
     if not domains:
         sys.exit("\n  <> No domains found.")
@@ -113,13 +95,16 @@ def main():
 
     # Pre-compute values outside loop for maximum performance
     holdtime_str = str(holdtime)
+    commands = build_commands(selected_domain, holdtime_str)
     pause_time_sec = pause_time_ms / 1000  # Convert once, not per iteration
+    send = send_text_debug if debug else send_text  # Decide once, not per key
     
     # Single final screen clear before main loop
     clear_screen()
     print(f"\n  # [domain: {selected_domain}] <> [hold/ms: {holdtime}] <> [space pause/ms: {pause_time_ms}]")
     print("\n  <> Type text to send. Press Ctrl+C to quit.\n")
 
+    virsh = open_virsh()
     try:
         while True:
             user_input = input("  <> Enter text: ")
@@ -128,32 +113,20 @@ def main():
             if not user_input:
                 continue
             
-            # Process each character with optimized hot path
-            for char in user_input:
-                key_sequence = KEY_MAP.get(char)
-                
-                # Early exit for unsupported characters
-                if not key_sequence:
-                    if debug:
-                        print(f"  [DEBUG] Unsupported char skipped: {repr(char)}")
-                    continue
-                
-                # Pre-compute debug string outside send_keys if needed
-                debug_info = None
-                if debug:
-                    formatted_seq = " + ".join(key_sequence) if len(key_sequence) > 1 else key_sequence[0]
-                    debug_info = f"  [DEBUG] Sending key: {repr(char)} → {formatted_seq}"
-                
-                send_keys(selected_domain, char, holdtime_str, key_sequence, debug_info)
-                
-                # Space pause with pre-computed value
-                if char == " ":
-                    if debug:
-                        print("  [DEBUG] Space detected → pausing...")
-                    time.sleep(pause_time_sec)
-                    
+            # A broken pipe or a sync that never arrives both mean the
+            # virsh shell exited under us
+            try:
+                delivered = send(virsh, user_input, commands, pause_time_sec)
+            except OSError:
+                delivered = False
+            if not delivered:
+                abort_virsh(virsh)
+                sys.exit("\n  <> virsh shell exited.")
+
     except KeyboardInterrupt:
         print("\n  <> Exiting...")
+        # Whatever is still queued was interrupted on purpose; don't type it
+        abort_virsh(virsh)
         sys.exit(0)
 
 # -------------------------------
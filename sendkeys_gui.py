@@ -1,131 +1,249 @@
 #!/usr/bin/env python3
 import sys
 import subprocess
+import queue
+import threading
 import time
+from collections.abc import Iterator
 from PyQt6.QtWidgets import (
     QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout,
     QLabel, QComboBox, QSpinBox, QTextEdit, QPushButton, QCheckBox,
     QMessageBox, QGroupBox
 )
-from PyQt6.QtCore import Qt, QThread, pyqtSignal, QSize
-from PyQt6.QtGui import QFont
+from PyQt6.QtCore import Qt, QThread, QTimer, pyqtSignal, QSize
+from PyQt6.QtGui import QFont, QTextCursor
 
-# -------------------------------
-# Utility Functions
-# -------------------------------
-
-def run_cmd(cmd: list[str]) -> str:
-    """Run a system command and return its output, or an empty string if it fails."""
-    try:
-        return subprocess.check_output(cmd, text=True, stderr=subprocess.DEVNULL).strip()
-    except subprocess.CalledProcessError:
-        return ""
-
-def get_domains() -> list[str]:
-    """Retrieve available domains from virsh."""
-    output = run_cmd(["sudo", "virsh", "list", "--all"])
-    lines = output.splitlines()[2:]
-    return [line.split()[1] for line in lines if len(line.split()) > 1]
-
-def send_keys(domain: str, key_sequence: list[str], holdtime_str: str):
-    """Send keypress to a virsh domain using send-key."""
-    cmd = ["sudo", "virsh", "send-key", domain, "--codeset", "usb", *key_sequence, "--holdtime", holdtime_str]
-    subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
-
-# -------------------------------
-# Key Map (Pre-computed constant)
-# -------------------------------
-
-def _build_key_map() -> dict[str, list[str]]:
-    """Build and pre-compute key map as lists for optimal performance."""
-    base_symbols = {
-        '-': '0x2d', '=': '0x2e', '[': '0x2f', ']': '0x30', '\\': '0x64',
-        ';': '0x33', "'": '0x34', ',': '0x36', '.': '0x37', '/': '0x38', '`': '0x35'
-    }
-    shift_pairs = {
-        '-': '_', '=': '+', '[': '{', ']': '}', '\\': '|',
-        ';': ':', "'": '"', ',': '<', '.': '>', '/': '?', '`': '~'
-    }
-
-    key_map_str = {
-        **{chr(c): f"0x{c - 93:02x}" for c in range(97, 123)},
-        **{chr(c): f"0xe1 0x{c - 61:02x}" for c in range(65, 91)},
-        **{str(i): f"0x{0x1d + i:02x}" for i in range(1, 10)},
-        "0": "0x27",
-        **{s: f"0xe1 0x{0x1d + i:02x}" for s, i in zip("!@#$%^&*()", range(1, 11))},
-        **base_symbols,
-        **{shift_pairs[k]: f"0xe1 {v}" for k, v in base_symbols.items() if k in shift_pairs},
-        " ": "0x2c", "\n": "0x28", "\t": "0x2b",
-    }
-
-    return {char: seq.split() for char, seq in key_map_str.items()}
-
-KEY_MAP = _build_key_map()
+from virsh import (
+    SUDO_REFRESH, SYNC_INTERVAL, abort_virsh, authenticate_sudo, close_virsh,
+    get_domains, open_virsh, refresh_sudo, wait_virsh
+)
 
 # -------------------------------
 # Worker Thread
 # -------------------------------
 
+# Progress lines are handed to the UI in batches, flushed at whichever
+# limit is reached first, so long debug sends don't flood the event queue
+PROGRESS_BATCH = 64
+PROGRESS_INTERVAL = 0.05
+
 class KeySenderThread(QThread):
-    """Thread to send keys without blocking the UI."""
+    """Long-lived thread that sends queued texts without blocking the UI.
+
+    One thread (and one virsh shell) serves every Send click; jobs arrive
+    through `submit` and `finished` is emitted after each of them.
+    """
     progress = pyqtSignal(str)
     finished = pyqtSignal()
     error = pyqtSignal(str)
 
-    def __init__(self, domain: str, text: str, holdtime: int, pause_time: int, debug: bool):
+    def __init__(self):
         super().__init__()
-        self.domain = domain
-        self.text = text
-        self.holdtime = str(holdtime)
-        self.pause_time = pause_time / 1000
-        self.debug = debug
-        self._is_running = True
+        self.queue: queue.Queue[tuple[str, str, int, int, bool] | None] = queue.Queue()
+        self.pause_time = 0.0
+        self._stop_event = threading.Event()
+        self._virsh: subprocess.Popen | None = None
+        self._buf: list[str] = []
+        self._last_flush = time.monotonic()
+
+    def _log(self, message: str):
+        """Queue a progress line, emitting the batch once it is large or old enough."""
+        self._buf.append(message)
+        if len(self._buf) >= PROGRESS_BATCH or time.monotonic() - self._last_flush > PROGRESS_INTERVAL:
+            self._flush_log()
+
+    def _flush_log(self):
+        """Emit all queued progress lines as one message."""
+        if self._buf:
+            self.progress.emit("\n".join(self._buf))
+            self._buf.clear()
+        self._last_flush = time.monotonic()
+
+    def _pause_for_spaces(self, virsh: subprocess.Popen, spaces: int):
+        """Pause once for a run of spaces, counted from when the guest received them.
+
+        Waits on the stop event rather than sleeping, so Stop cuts the pause short.
+        """
+        wait_virsh(virsh)
+        self._stop_event.wait(self.pause_time * spaces)
+
+    def _send_text(self, virsh: subprocess.Popen, keys: Iterator[tuple[str, str | None, str | None]]):
+        """Write every key group to virsh. The common path, free of debug checks.
+
+        Expects text already passed through strip_unsupported.
+        """
+        for n, (chars, command, _) in enumerate(keys, 1):
+            if self._stop_event.is_set():
+                return
+
+            virsh.stdin.write(command)
+            # A run of spaces arrives as one group and gets one combined pause
+            if chars[0] == " ":
+                self._pause_for_spaces(virsh, len(chars))
+            elif n % SYNC_INTERVAL == 0:
+                wait_virsh(virsh)
+
+    def _send_text_debug(self, virsh: subprocess.Popen, keys: Iterator[tuple[str, str | None, str | None]]):
+        """Same as _send_text, logging every step."""
+        for n, (chars, command, formatted_seq) in enumerate(keys, 1):
+            if self._stop_event.is_set():
+                return
+            if command is None:
+                self._log(f"⚠ Unsupported char skipped: {repr(chars)}")
+                continue
+
+            self._log(f"→ Sending: {repr(chars)} ({formatted_seq})")
+            virsh.stdin.write(command)
+            if chars[0] == " ":
+                self._log(f"⏸ Space detected → pausing {self.pause_time*len(chars)*1000:.0f}ms...")
+                self._flush_log()
+                self._pause_for_spaces(virsh, len(chars))
+            elif n % SYNC_INTERVAL == 0:
+                wait_virsh(virsh)
+
+    def _drop_virsh(self, virsh: subprocess.Popen | None):
+        """Discard a stopped or broken shell, with every command it has not run."""
+        if virsh is None:
+            return
+        if self._virsh is virsh:
+            self._virsh = None
+        abort_virsh(virsh)
 
-    def run(self):
+    def _send_job(self, domain: str, text: str, holdtime: int, pause_time: int, debug: bool):
+        """Send one queued text, reusing the virsh shell from earlier jobs."""
+        virsh = self._virsh
         try:
-            for char in self.text:
-                if not self._is_running:
-                    break
-
-                key_sequence = KEY_MAP.get(char)
-                if not key_sequence:
-                    if self.debug:
-                        self.progress.emit(f"⚠ Unsupported char skipped: {repr(char)}")
-                    continue
-
-                if self.debug:
-                    formatted_seq = " + ".join(key_sequence) if len(key_sequence) > 1 else key_sequence[0]
-                    self.progress.emit(f"→ Sending: {repr(char)} ({formatted_seq})")
-
-                send_keys(self.domain, key_sequence, self.holdtime)
-
-                if char == " ":
-                    if self.debug:
-                        self.progress.emit(f"⏸ Space detected → pausing {self.pause_time*1000:.0f}ms...")
-                    time.sleep(self.pause_time)
-
-            if self._is_running:
-                self.progress.emit("✓ Complete")
-        except Exception as e:
-            self.error.emit(str(e))
+            # Imported on first send so the key map isn't built before the window shows
+            from keymap import build_commands, group_keys, strip_unsupported
+
+            commands = build_commands(domain, str(holdtime))
+            self.pause_time = pause_time / 1000
+            # Pick the loop once instead of checking debug for every key
+            send = self._send_text_debug if debug else self._send_text
+            if not debug:
+                # Only the debug loop reports skipped characters
+                text = strip_unsupported(text)
+
+            # A Stop that came in after the previous job ended may have ended its shell
+            if virsh is not None and virsh.poll() is not None:
+                self._drop_virsh(virsh)
+                virsh = None
+            if virsh is None:
+                virsh = self._virsh = open_virsh()
+            send(virsh, group_keys(text, commands, debug))
+            if not self._stop_event.is_set() and wait_virsh(virsh):
+                self._log("✓ Complete")
+        # Spawning sudo or writing to a dead virsh shell
+        except (OSError, subprocess.SubprocessError) as e:
+            # Stop ends the shell under a running send, which is not an error
+            if not self._stop_event.is_set():
+                self._flush_log()
+                self.error.emit(str(e))
+            # Start from a fresh shell next time in case this one broke
+            self._drop_virsh(virsh)
         finally:
+            # Keys still queued when Stop was clicked must never reach the guest
+            if self._stop_event.is_set():
+                self._drop_virsh(virsh)
+            self._flush_log()
             self.finished.emit()
 
+    def run(self):
+        while (job := self.queue.get()) is not None:
+            try:
+                self._send_job(*job)
+            except Exception as e:
+                # Report anything unexpected rather than lose the only worker;
+                # the shell may be mid-command, so the next job starts afresh
+                self._drop_virsh(self._virsh)
+                self.error.emit(f"Unexpected error: {e}")
+        if self._virsh:
+            close_virsh(self._virsh)
+
+    def submit(self, job: tuple[str, str, int, int, bool]):
+        """Queue a text to send. Called from the GUI thread.
+
+        The stop event is reset here rather than when the job is dequeued,
+        so a Stop clicked before the worker picks the job up still applies.
+        """
+        self._stop_event.clear()
+        self.queue.put(job)
+
     def stop(self):
-        self._is_running = False
+        """Abort the job currently being sent, along with the keys virsh has queued."""
+        self._stop_event.set()
+        # Ending the shell also wakes a worker blocked in wait_virsh
+        if (virsh := self._virsh) is not None:
+            virsh.terminate()
+
+    def shutdown(self):
+        """Abort any job, end the thread and wait for it."""
+        self.stop()
+        self.queue.put(None)
+        self.wait()
 
 # -------------------------------
 # Main GUI Application
 # -------------------------------
 
+# Progress received from the worker is written to the output area at most
+# once per interval, so the document relays out a few times per second
+LOG_FLUSH_MS = 50
+
+# Built once at import; every window shares the same string
+_DARK_STYLESHEET = """
+    QMainWindow { background-color: #1e1e1e; }
+    QWidget { background-color: #1e1e1e; color: #e0e0e0; }
+    QGroupBox { color: #e0e0e0; border: 1px solid #404040; border-radius: 5px; margin-top: 10px; padding-top: 10px; }
+    QGroupBox::title { subcontrol-origin: margin; left: 10px; padding: 0 3px 0 3px; }
+    QLabel { color: #e0e0e0; }
+    QComboBox { background-color: #2d2d2d; color: #e0e0e0; border: 1px solid #404040; border-radius: 4px; padding: 5px; }
+    QComboBox::drop-down { border: none; background-color: #2d2d2d; }
+    QComboBox QAbstractItemView { background-color: #2d2d2d; color: #e0e0e0; selection-background-color: #0d47a1; border: 1px solid #404040; }
+    QSpinBox { background-color: #2d2d2d; color: #e0e0e0; border: 1px solid #404040; border-radius: 4px; padding: 4px; font-size: 14px; }
+    QSpinBox::up-button { width: 24px; }
+    QSpinBox::down-button { width: 24px; }
+    QTextEdit { background-color: #2d2d2d; color: #e0e0e0; border: 1px solid #404040; border-radius: 4px; padding: 5px; }
+    QPushButton { background-color: #0d47a1; color: #ffffff; border: none; border-radius: 4px; padding: 6px; font-weight: bold; }
+    QPushButton:hover { background-color: #1565c0; }
+    QPushButton:pressed { background-color: #0a3d91; }
+    QPushButton:disabled { background-color: #404040; color: #808080; }
+    QCheckBox { color: #e0e0e0; spacing: 5px; }
+    QCheckBox::indicator { width: 18px; height: 18px; }
+    QCheckBox::indicator:unchecked { background-color: #2d2d2d; border: 1px solid #404040; border-radius: 3px; }
+    QCheckBox::indicator:checked { background-color: #0d47a1; border: 1px solid #0d47a1; border-radius: 3px; }
+"""
+
 class VirshKeySenderGUI(QMainWindow):
+    domains_loaded = pyqtSignal(int, list)
+
     def __init__(self):
         super().__init__()
         self.setWindowTitle("Virsh SendKeys GUI")
         self.setGeometry(100, 100, 550, 600)
         self.setMinimumSize(QSize(450, 530))
 
-        self.worker_thread = None
+        self.worker = KeySenderThread()
+        self.worker.progress.connect(self.on_progress)
+        self.worker.finished.connect(self.on_finished)
+        self.worker.error.connect(self.on_error)
+        self.worker.start()
+        self.domains_loaded.connect(self.on_domains_loaded)
+        # Numbers each domain lookup so a slow, older one can't overwrite a newer result
+        self._domains_request = 0
+
+        self._log_buf: list[str] = []
+        self._log_timer = QTimer(self)
+        self._log_timer.setInterval(LOG_FLUSH_MS)
+        self._log_timer.timeout.connect(self._flush_log)
+
+        # Authenticate once up front; the timer keeps the sudo timestamp fresh.
+        # On failure refresh_domains reports that no domains were found.
+        authenticate_sudo()
+        self.sudo_timer = QTimer(self)
+        self.sudo_timer.timeout.connect(refresh_sudo)
+        self.sudo_timer.start(SUDO_REFRESH * 1000)
+
         self.apply_dark_theme()
         self.setup_ui()
 
@@ -155,7 +273,7 @@ class VirshKeySenderGUI(QMainWindow):
         self.domain_combo.setMinimumWidth(150)
         domain_layout.addWidget(self.domain_combo)
         refresh_btn = QPushButton("Refresh")
-        refresh_btn.clicked.connect(self.refresh_domains)
+        refresh_btn.clicked.connect(lambda: self.refresh_domains(force=True))
         refresh_btn.setMaximumWidth(65)
         refresh_btn.setMaximumHeight(26)
         domain_layout.addWidget(refresh_btn)
@@ -229,6 +347,8 @@ class VirshKeySenderGUI(QMainWindow):
         self.output_text.setReadOnly(True)
         self.output_text.setMinimumHeight(80)
         self.output_text.setMaximumHeight(120)
+        # Progress is written through this one cursor rather than a fresh one per flush
+        self._log_cursor = QTextCursor(self.output_text.document())
         output_layout.addWidget(self.output_text)
         output_group.setLayout(output_layout)
         layout.addWidget(output_group)
@@ -271,33 +391,24 @@ class VirshKeySenderGUI(QMainWindow):
 
     def apply_dark_theme(self):
         """Apply dark theme stylesheet."""
-        self.setStyleSheet("""
-            QMainWindow { background-color: #1e1e1e; }
-            QWidget { background-color: #1e1e1e; color: #e0e0e0; }
-            QGroupBox { color: #e0e0e0; border: 1px solid #404040; border-radius: 5px; margin-top: 10px; padding-top: 10px; }
-            QGroupBox::title { subcontrol-origin: margin; left: 10px; padding: 0 3px 0 3px; }
-            QLabel { color: #e0e0e0; }
-            QComboBox { background-color: #2d2d2d; color: #e0e0e0; border: 1px solid #404040; border-radius: 4px; padding: 5px; }
-            QComboBox::drop-down { border: none; background-color: #2d2d2d; }
-            QComboBox QAbstractItemView { background-color: #2d2d2d; color: #e0e0e0; selection-background-color: #0d47a1; border: 1px solid #404040; }
-            QSpinBox { background-color: #2d2d2d; color: #e0e0e0; border: 1px solid #404040; border-radius: 4px; padding: 4px; font-size: 14px; }
-            QSpinBox::up-button { width: 24px; }
-            QSpinBox::down-button { width: 24px; }
-            QTextEdit { background-color: #2d2d2d; color: #e0e0e0; border: 1px solid #404040; border-radius: 4px; padding: 5px; }
-            QPushButton { background-color: #0d47a1; color: #ffffff; border: none; border-radius: 4px; padding: 6px; font-weight: bold; }
-            QPushButton:hover { background-color: #1565c0; }
-            QPushButton:pressed { background-color: #0a3d91; }
-            QPushButton:disabled { background-color: #404040; color: #808080; }
-            QCheckBox { color: #e0e0e0; spacing: 5px; }
-            QCheckBox::indicator { width: 18px; height: 18px; }
-            QCheckBox::indicator:unchecked { background-color: #2d2d2d; border: 1px solid #404040; border-radius: 3px; }
-            QCheckBox::indicator:checked { background-color: #0d47a1; border: 1px solid #0d47a1; border-radius: 3px; }
-        """)
-
-    def refresh_domains(self):
-        """Refresh the list of available domains."""
+        self.setStyleSheet(_DARK_STYLESHEET)
+
+    def refresh_domains(self, force: bool = False):
+        """Refresh the list of available domains on a background thread.
+
+        `virsh list` can take hundreds of milliseconds, so the result comes
+        back through domains_loaded instead of stalling the event loop.
+        """
+        self.domain_combo.clear()
+        self._domains_request += 1
+        request = self._domains_request
+        threading.Thread(target=lambda: self.domains_loaded.emit(request, get_domains(force)), daemon=True).start()
+
+    def on_domains_loaded(self, request: int, domains: list[str]):
+        """Fill the domain list once virsh has answered the latest lookup."""
+        if request != self._domains_request:
+            return
         self.domain_combo.clear()
-        domains = get_domains()
         if not domains:
             self.domain_combo.addItem("(No domains found)")
             self.output_text.setText("⚠ No domains found. Make sure virsh is available and sudo access is granted.")
@@ -306,7 +417,7 @@ class VirshKeySenderGUI(QMainWindow):
 
     def send_text(self):
         """Send the text from input to the selected domain."""
-        if self.worker_thread and self.worker_thread.isRunning():
+        if not self.send_btn.isEnabled():
             QMessageBox.warning(self, "Warning", "Already sending text. Please wait or click Stop.")
             return
 
@@ -316,44 +427,58 @@ class VirshKeySenderGUI(QMainWindow):
             return
 
         domain = self.domain_combo.currentText()
-        if domain == "(No domains found)":
+        if not domain or domain == "(No domains found)":
             QMessageBox.critical(self, "Error", "No valid domain selected.")
             return
 
         self.output_text.clear()
         self.output_text.append("◄ Starting transmission...\n")
+        self._log_timer.start()
 
         self.send_btn.setEnabled(False)
         self.stop_btn.setEnabled(True)
 
-        self.worker_thread = KeySenderThread(
+        self.worker.submit((
             domain, text, self.holdtime_spin.value(),
             self.pause_spin.value(), self.debug_check.isChecked()
-        )
-        self.worker_thread.progress.connect(self.on_progress)
-        self.worker_thread.finished.connect(self.on_finished)
-        self.worker_thread.error.connect(self.on_error)
-        self.worker_thread.start()
+        ))
 
     def stop_sending(self):
         """Stop the current transmission."""
-        if self.worker_thread and self.worker_thread.isRunning():
-            self.worker_thread.stop()
-            self.output_text.append("\n◄ Stopping transmission...")
+        if not self.send_btn.isEnabled():
+            self.worker.stop()
+            self._log_buf.append("\n◄ Stopping transmission...")
 
     def on_progress(self, message: str):
         """Handle progress updates from worker thread."""
-        self.output_text.append(message)
+        self._log_buf.append(message)
+
+    def _flush_log(self):
+        """Write all buffered progress to the output area in one insert."""
+        if self._log_buf:
+            self._log_cursor.movePosition(QTextCursor.MoveOperation.End)
+            self._log_cursor.insertText("\n".join(self._log_buf) + "\n")
+            self._log_buf.clear()
+            # Keep the latest lines in view
+            self.output_text.setTextCursor(self._log_cursor)
 
     def on_error(self, error: str):
         """Handle errors from worker thread."""
-        self.output_text.append(f"\n✗ Error: {error}")
+        self._log_buf.append(f"\n✗ Error: {error}")
+        self._flush_log()
         QMessageBox.critical(self, "Error", f"An error occurred:\n{error}")
 
     def on_finished(self):
         """Handle worker thread completion."""
         self.send_btn.setEnabled(True)
         self.stop_btn.setEnabled(False)
+        self._log_timer.stop()
+        self._flush_log()
+
+    def closeEvent(self, event):
+        """Stop the worker thread before the window goes away."""
+        self.worker.shutdown()
+        super().closeEvent(event)
 
     def clear_output(self):
         """Clear the output text area."""
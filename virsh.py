@@ -0,0 +1,132 @@
+import functools
+import shutil
+import subprocess
+import threading
+import time
+
+# -------------------------------
+# Sudo
+# -------------------------------
+
+# Absolute path lets subprocess take its posix_spawn (vfork) fast path
+# instead of fork + exec, which copies the page tables of the whole process
+SUDO = shutil.which("sudo") or "sudo"
+
+def run_cmd(cmd: list[str]) -> str:
+    """Run a system command and return its output, or an empty string if it fails."""
+    try:
+        return subprocess.check_output(cmd, text=True, stderr=subprocess.DEVNULL, close_fds=False).strip()
+    except subprocess.CalledProcessError:
+        return ""
+
+# Seconds between sudo timestamp refreshes (sudo's default timeout is 5 minutes)
+SUDO_REFRESH = 60
+
+def authenticate_sudo() -> bool:
+    """Cache sudo credentials once so every later `sudo -n` call skips authentication."""
+    return subprocess.run([SUDO, "-v"], close_fds=False).returncode == 0
+
+def refresh_sudo():
+    """Extend the cached sudo timestamp without ever prompting."""
+    subprocess.run([SUDO, "-n", "-v"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, close_fds=False)
+
+def keep_sudo_alive():
+    """Refresh the sudo timestamp every SUDO_REFRESH seconds on a daemon timer."""
+    def tick():
+        refresh_sudo()
+        keep_sudo_alive()
+
+    timer = threading.Timer(SUDO_REFRESH, tick)
+    timer.daemon = True
+    timer.start()
+
+# -------------------------------
+# Domains
+# -------------------------------
+
+# `virsh list` results are reused within the same DOMAINS_TTL-second window
+DOMAINS_TTL = 30
+
+@functools.lru_cache(maxsize=1)
+def _get_domains_cached(bucket: int) -> list[str]:
+    """Query virsh for domain names; `bucket` only keys the cache to a time window."""
+    domains = []
+    for line in run_cmd([SUDO, "-n", "virsh", "list", "--all"]).splitlines()[2:]:  # Skip header lines
+        # maxsplit=2: only the Id and Name columns are needed
+        parts = line.split(None, 2)
+        if len(parts) >= 2:
+            domains.append(parts[1])
+    return domains
+
+def get_domains(force: bool = False) -> list[str]:
+    """Retrieve available domains from virsh, cached unless `force` is set."""
+    if force:
+        _get_domains_cached.cache_clear()
+    return _get_domains_cached(int(time.monotonic() // DOMAINS_TTL))
+
+# -------------------------------
+# Virsh Shell
+# -------------------------------
+
+# Marker echoed back by virsh once it has worked through all queued commands
+SYNC_MARKER = "sendkeys-sync"
+
+# Key groups written between syncs, so virsh never has more than this many
+# commands queued behind the one it is typing
+SYNC_INTERVAL = 16
+
+# Bytes of queued commands buffered per pipe write (roughly 32 send-key
+# lines), enough that each stretch between syncs goes out in one write
+VIRSH_BUFFER = 2048
+
+def quote_arg(value: str) -> str:
+    """Quote a value for virsh's own command-line parser.
+
+    Inside single quotes virsh takes every character literally, so only an
+    embedded ' needs splicing in as \\' between two quoted halves.
+    """
+    return "'" + value.replace("'", "'\\''") + "'"
+
+def open_virsh() -> subprocess.Popen:
+    """Start a single interactive virsh shell that reads commands from stdin.
+
+    Keeping one shell alive avoids a sudo + virsh fork/exec per keystroke.
+    """
+    return subprocess.Popen(
+        [SUDO, "-n", "virsh"], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL, text=True, bufsize=VIRSH_BUFFER, close_fds=False
+    )
+
+def wait_virsh(virsh: subprocess.Popen) -> bool:
+    """Block until virsh has executed every command written so far.
+
+    Returns False if the shell exited first.
+    """
+    virsh.stdin.write(f"echo {SYNC_MARKER}\n")
+    virsh.stdin.flush()
+    for line in virsh.stdout:
+        if SYNC_MARKER in line:
+            return True
+    return False
+
+def close_virsh(virsh: subprocess.Popen):
+    """Ask the virsh shell to quit and reap it."""
+    try:
+        virsh.stdin.write("quit\n")
+        virsh.stdin.close()
+    except BrokenPipeError:
+        pass
+    virsh.wait()
+
+def abort_virsh(virsh: subprocess.Popen):
+    """End the virsh shell at once, dropping every command it has not run yet.
+
+    sudo relays the SIGTERM to virsh; whatever is still buffered on our side
+    of the pipe is discarded rather than flushed.
+    """
+    virsh.terminate()
+    virsh.wait()
+    try:
+        virsh.stdin.close()
+    except BrokenPipeError:
+        pass